@@ -2,15 +2,32 @@
 a virtual environment and then start the actual process.
 """
 
+import hashlib
 import subprocess
 import os
 import sys
+from pathlib import Path
 
 script_directory = os.path.dirname(os.path.realpath(__file__))
 os.chdir(script_directory)
 
-subprocess.run("python -m venv .venv", check=True)
-subprocess.run(r'.venv\Scripts\pip install .', check=True)
+BOOTSTRAP_HASH_FILE = os.path.join(".venv", ".bootstrap_hash")
+
+# Only reinstall the requirements when pyproject.toml has changed since the last run.
+# The robot itself is run from this directory, so code changes don't need a reinstall.
+REQUIREMENTS_HASH = hashlib.sha256(Path("pyproject.toml").read_bytes()).hexdigest()
+
+installed_hash = None
+if os.path.isfile(BOOTSTRAP_HASH_FILE):
+    with open(BOOTSTRAP_HASH_FILE, encoding="utf-8") as hash_file:
+        installed_hash = hash_file.read().strip()
+
+if installed_hash != REQUIREMENTS_HASH:
+    subprocess.run("python -m venv .venv", check=True)
+    subprocess.run(r'.venv\Scripts\pip install .', check=True)
+
+    with open(BOOTSTRAP_HASH_FILE, "w", encoding="utf-8") as hash_file:
+        hash_file.write(REQUIREMENTS_HASH)
 
 command_args = [r".venv\Scripts\python", "-m", "robot_framework"] + sys.argv[1:]
 
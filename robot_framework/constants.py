@@ -0,0 +1,28 @@
+"""This module has functionality to fetch constants from OpenOrchestrator only once per run."""
+
+from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
+
+# The attribute on the OrchestratorConnection holding the values of the constants fetched so far
+_CONSTANT_CACHE_ATTRIBUTE = "_constant_values"
+
+
+def get_constant_value(orchestrator_connection: OrchestratorConnection, constant_name: str) -> str:
+    """Get the value of a constant from OpenOrchestrator.
+    The value is cached on the connection, so the database is only queried the first time.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+        constant_name: The name of the constant.
+
+    Returns:
+        str: The value of the constant.
+    """
+    constant_values = getattr(orchestrator_connection, _CONSTANT_CACHE_ATTRIBUTE, None)
+    if constant_values is None:
+        constant_values = {}
+        setattr(orchestrator_connection, _CONSTANT_CACHE_ATTRIBUTE, constant_values)
+
+    if constant_name not in constant_values:
+        constant_values[constant_name] = orchestrator_connection.get_constant(constant_name).value
+
+    return constant_values[constant_name]
@@ -7,6 +7,7 @@ from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConn
 
 from robot_framework import config
 from robot_framework import error_screenshot
+from robot_framework.constants import get_constant_value
 
 
 class BusinessError(Exception):
@@ -26,7 +27,7 @@ def handle_error(message: str, error: Exception, queue_element: QueueElement | N
         orchestrator_connection: A connection to OpenOrchestrator.
     """
     error_msg = f"{message}: {repr(error)}\n\nTrace:\n{traceback.format_exc()}"
-    error_email = orchestrator_connection.get_constant(config.ERROR_EMAIL).value
+    error_email = get_constant_value(orchestrator_connection, config.ERROR_EMAIL)
 
     orchestrator_connection.log_error(error_msg)
     if queue_element:
@@ -1,12 +1,140 @@
 """This module contains the main process of the robot."""
+
+# The subprocesses pull in heavy dependencies (pandas, selenium), so they are only
+# imported by the handler that needs them:
+# pylint: disable=import-outside-toplevel
+
 import os
 import json
-import pyodbc
+from typing import Callable
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 from OpenOrchestrator.database.queues import QueueStatus
-from robot_framework.subprocesses.overview_creation import run_overview_creation
-from robot_framework.subprocesses.queue_upload import retrieve_changes, upload_to_queue
-from robot_framework.subprocesses.queue_handling import process_queue_elements
+from robot_framework import config
+from robot_framework.constants import get_constant_value  # noqa: F401  pylint: disable=unused-import
+
+# The connection string of the RPA database, read once when the robot starts
+DB_CONNECTION_STRING = os.getenv('DbConnectionString')
+
+# The attribute on the OrchestratorConnection holding (raw string, parsed dict) of its process arguments
+_ARGS_CACHE_ATTRIBUTE = "_parsed_process_arguments"
+
+
+def get_process_arguments(orchestrator_connection: OrchestratorConnection) -> dict:
+    """Parse the process arguments of the connection, reusing the previous result
+    as long as the raw argument string is unchanged.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+
+    Returns:
+        dict: The parsed process arguments.
+    """
+    raw_args = orchestrator_connection.process_arguments
+    cached = getattr(orchestrator_connection, _ARGS_CACHE_ATTRIBUTE, None)
+    if cached and cached[0] is raw_args:
+        return cached[1]
+
+    parsed_args = json.loads(raw_args)
+    setattr(orchestrator_connection, _ARGS_CACHE_ATTRIBUTE, (raw_args, parsed_args))
+    return parsed_args
+
+
+def clear_queue(orchestrator_connection: OrchestratorConnection) -> None:
+    """Delete all elements in the queue.
+    OpenOrchestrator has no bulk delete, so the elements are fetched in as few
+    round-trips as possible and deleted one by one.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+    """
+    while True:
+        queue_elements = orchestrator_connection.get_queue_elements(config.QUEUE_NAME, limit=config.MAX_TASK_COUNT)
+        if not queue_elements:
+            break
+        for element in queue_elements:
+            orchestrator_connection.delete_queue_element(element.id)
+
+
+def create_overview(oc_args_json: dict, orchestrator_connection: OrchestratorConnection) -> None:
+    """Create the overview of dataaftaler in STIL."""
+    import pyodbc
+    from robot_framework.subprocesses.overview_creation import run_overview_creation
+
+    # connection_string = get_constant_value(orchestrator_connection, 'DbConnectionString')
+    connection_string = DB_CONNECTION_STRING  # For testing
+    base_dir = oc_args_json['base_dir']
+    notification_mail = oc_args_json['notification_mail']
+    dagtilbud = oc_args_json['dagtilbud']
+    institutioner = oc_args_json['institutioner']
+    orchestrator_connection.log_trace("Starting overview creation.")
+    try:
+        run_overview_creation(base_dir, connection_string, notification_mail, dagtilbud, institutioner)
+    except pyodbc.Error as error:
+        orchestrator_connection.log_trace(f"Database error: {str(error)}")
+    else:
+        orchestrator_connection.log_trace("Overview creation completed.")
+
+
+def upload_changes(base_dir: str, orchestrator_connection: OrchestratorConnection) -> None:
+    """Replace the elements in the queue with the changes from the overview.
+
+    Args:
+        base_dir: The base directory for all Dataaftaler-processes.
+        orchestrator_connection: The connection to OpenOrchestrator.
+    """
+    from robot_framework.subprocesses.queue_upload import retrieve_changes, upload_to_queue
+
+    # Delete all elements in the queue before uploading new ones
+    clear_queue(orchestrator_connection)
+
+    orchestrator_connection.log_trace("Retrieving changes from overview.")
+    approve_data, delete_data, wait_data = retrieve_changes(base_dir)
+    if not any((approve_data, delete_data, wait_data)):
+        orchestrator_connection.log_trace("No changes in overview. Nothing to upload.")
+        return
+
+    orchestrator_connection.log_trace("Changes retrieved. Uploading to queue.")
+    upload_to_queue(approve_data, delete_data, wait_data, orchestrator_connection)
+    orchestrator_connection.log_trace("Queue upload completed.")
+
+
+def upload_and_handle_queue(oc_args_json: dict, orchestrator_connection: OrchestratorConnection) -> None:
+    """Upload the changes from the overview to the queue and handle the queue elements."""
+    from robot_framework.subprocesses.queue_handling import process_queue_elements
+
+    upload_changes(oc_args_json['base_dir'], orchestrator_connection)
+
+    # Handle queue elements
+    queue_elements = orchestrator_connection.get_queue_elements("Databehandlingsaftale_Status_Queue")
+    if queue_elements:
+        orchestrator_connection.log_trace(f"Handling {len(queue_elements)} queue elements.")
+        process_queue_elements(queue_elements, orchestrator_connection)
+        orchestrator_connection.log_trace("Queue handling completed.")
+
+
+def queue_upload(oc_args_json: dict, orchestrator_connection: OrchestratorConnection) -> None:
+    """Upload the changes from the overview to the queue."""
+    upload_changes(oc_args_json['base_dir'], orchestrator_connection)
+
+
+def handle_queue(_oc_args_json: dict, orchestrator_connection: OrchestratorConnection) -> None:
+    """Handle the new elements in the queue."""
+    from robot_framework.subprocesses.queue_handling import process_queue_elements
+
+    queue_elements = orchestrator_connection.get_queue_elements(queue_name="Databehandlingsaftale_Status_Queue", status=QueueStatus.NEW, limit=1000)
+    if queue_elements:
+        orchestrator_connection.log_trace(f"Handling {len(queue_elements)} queue elements.")
+        process_queue_elements(queue_elements, orchestrator_connection)
+        orchestrator_connection.log_trace("Queue handling completed.")
+
+
+# The handler for each value of the 'process' argument
+HANDLERS: dict[str, Callable[[dict, OrchestratorConnection], None]] = {
+    'create_overview': create_overview,
+    'upload_and_handle_queue': upload_and_handle_queue,
+    'queue_upload': queue_upload,
+    'handle_queue': handle_queue,
+}
 
 
 def process(orchestrator_connection: OrchestratorConnection) -> None:
@@ -14,69 +142,14 @@ def process(orchestrator_connection: OrchestratorConnection) -> None:
     orchestrator_connection.log_trace("Running main process.")
 
     try:
-        # connection_string = orchestrator_connection.get_constant('DbConnectionString').value
-        connection_string = os.getenv('DbConnectionString')  # For testing
-        oc_args_json = json.loads(orchestrator_connection.process_arguments)
+        oc_args_json = get_process_arguments(orchestrator_connection)
         process_arg = oc_args_json['process']
 
-        if process_arg == 'create_overview':
-            base_dir = oc_args_json['base_dir']
-            notification_mail = oc_args_json['notification_mail']
-            dagtilbud = oc_args_json['dagtilbud']
-            institutioner = oc_args_json['institutioner']
-            orchestrator_connection.log_trace("Starting overview creation.")
-            run_overview_creation(base_dir, connection_string, notification_mail, dagtilbud, institutioner)
-            orchestrator_connection.log_trace("Overview creation completed.")
-
-        elif process_arg == 'upload_and_handle_queue':
-            # Delete all elements in the queue before uploading new ones
-            base_dir = oc_args_json['base_dir']
-            queue_elements = orchestrator_connection.get_queue_elements("Databehandlingsaftale_Status_Queue")
-            for element in queue_elements:
-                orchestrator_connection.delete_queue_element(element.id)
-
-            # Retrieve changes and upload
-            orchestrator_connection.log_trace("Retrieving changes from overview.")
-            approve_data, delete_data, wait_data = retrieve_changes(base_dir)
-            orchestrator_connection.log_trace("Changes retrieved. Uploading to queue.")
-            upload_to_queue(approve_data, delete_data, wait_data, orchestrator_connection)
-            orchestrator_connection.log_trace("Queue upload completed.")
-
-            # Handle queue elements
-            queue_elements = orchestrator_connection.get_queue_elements("Databehandlingsaftale_Status_Queue")
-            if queue_elements:
-                orchestrator_connection.log_trace(f"Handling {len(queue_elements)} queue elements.")
-                process_queue_elements(queue_elements, orchestrator_connection)
-                orchestrator_connection.log_trace("Queue handling completed.")
-
-        elif process_arg == 'queue_upload':
-            # Delete all elements in the queue before uploading new ones
-            base_dir = oc_args_json['base_dir']
-            while True:
-                queue_elements = orchestrator_connection.get_queue_elements("Databehandlingsaftale_Status_Queue")
-                if not queue_elements:
-                    break
-                for element in queue_elements:
-                    orchestrator_connection.delete_queue_element(element.id)
-
-            orchestrator_connection.log_trace("Retrieving changes from overview.")
-            approve_data, delete_data, wait_data = retrieve_changes(base_dir)
-            orchestrator_connection.log_trace("Changes retrieved. Uploading to queue.")
-            upload_to_queue(approve_data, delete_data, wait_data, orchestrator_connection)
-            orchestrator_connection.log_trace("Queue upload completed.")
-
-        elif process_arg == 'handle_queue':
-            queue_elements = orchestrator_connection.get_queue_elements(queue_name="Databehandlingsaftale_Status_Queue", status=QueueStatus.NEW, limit=1000)
-            if queue_elements:
-                orchestrator_connection.log_trace(f"Handling {len(queue_elements)} queue elements.")
-                process_queue_elements(queue_elements, orchestrator_connection)
-                orchestrator_connection.log_trace("Queue handling completed.")
-
-        else:
+        handler = HANDLERS.get(process_arg)
+        if handler is None:
             raise ValueError(f"Invalid process: {process_arg}")
 
-    except pyodbc.Error as error:
-        orchestrator_connection.log_trace(f"Database error: {str(error)}")
+        handler(oc_args_json, orchestrator_connection)
 
     except ValueError as e:
         orchestrator_connection.log_trace(f"Value error: {str(e)}")
@@ -1,10 +1,15 @@
 """ This module automates the process of extracting data from STIL and
 generates an overview. Export of results and errors to an Excel file and log files."""
+from contextlib import closing
 from datetime import datetime
+import itertools
 import os
+import re
 import time
 import shutil
 import sys
+import threading
+import uuid
 import pyodbc
 import pandas as pd
 from selenium import webdriver
@@ -13,8 +18,18 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException, ElementClickInterceptedException, StaleElementReferenceException
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.datavalidation import DataValidation
 
+# Seconds between checks for a finished download. The last interval is repeated.
+DOWNLOAD_POLL_INTERVALS = (0.05, 0.1, 0.2, 0.4, 0.8)
+
+# Seconds to wait after each failed click before trying again. The last interval is repeated.
+CLICK_RETRY_INTERVALS = (0.1, 0.25, 0.5, 1.0)
+
 
 def initialize_browser(base_dir):
     """Initialize the Selenium Chrome WebDriver with download preferences. """
@@ -38,32 +53,88 @@ def initialize_browser(base_dir):
     return webdriver.Chrome(options=chrome_options)
 
 
-def clear_base_directory(base_dir):
-    """Delete all files and subdirectories within the base directory."""
-    try:
-        if os.path.exists(base_dir):
-            shutil.rmtree(base_dir)
-            print(f"Successfully cleared the directory: {base_dir}")
+def delete_directories(directories):
+    """Delete the directories and log for each of them whether it could be deleted completely."""
+    for directory in directories:
+        errors = []
+        shutil.rmtree(directory, onerror=lambda _function, path, exc_info, errors=errors: errors.append(f"{path}: {exc_info[1]}"))
+        if errors:
+            print(f"Could not delete everything in {directory}, trying again on the next run: {'; '.join(errors)}")
         else:
-            print(f"The directory {base_dir} does not exist.")
-    except TimeoutException as e:
-        print(f"Timeout error: {e}")
-    except NoSuchElementException as e:
-        print(f"Element not found error: {e}")
+            print(f"Successfully deleted the directory: {directory}")
+
+
+def old_base_directories(base_dir):
+    """Find the directories that earlier runs moved aside, but couldn't delete completely."""
+    parent_dir, base_name = os.path.split(base_dir)
+    parent_dir = parent_dir or os.curdir
+    if not os.path.isdir(parent_dir):
+        return []
+
+    old_name_pattern = re.compile(re.escape(base_name) + r"\.[0-9a-f]{32}")
+    with os.scandir(parent_dir) as entries:
+        return [entry.path for entry in entries if entry.is_dir() and old_name_pattern.fullmatch(entry.name)]
+
+
+def clear_base_directory(base_dir):
+    """Delete all files and subdirectories within the base directory.
+    The directory is moved aside and deleted in a background thread, so the robot doesn't wait for it.
+    Directories left behind by earlier runs are deleted in the same thread."""
+    base_dir = os.path.normpath(base_dir)
+    old_dirs = old_base_directories(base_dir)
+
+    if os.path.exists(base_dir):
+        old_dir = f"{base_dir}.{uuid.uuid4().hex}"
+        try:
+            os.rename(base_dir, old_dir)
+            old_dirs.append(old_dir)
+            print(f"Moved the directory {base_dir} aside to {old_dir} to be deleted in the background.")
+        except OSError as e:
+            print(f"Could not move the directory {base_dir} aside, deleting it in place: {e}")
+            delete_directories([base_dir])
+    else:
+        print(f"The directory {base_dir} does not exist.")
+
+    if old_dirs:
+        # Not a daemon thread, so the deletion is allowed to finish before the robot exits
+        threading.Thread(target=delete_directories, args=(old_dirs,)).start()
+
+
+def set_download_directory(browser, download_dir):
+    """Create the directory and make the browser save downloads in it."""
+    os.makedirs(download_dir, exist_ok=True)
+    browser.execute_cdp_cmd("Browser.setDownloadBehavior", {"behavior": "allow", "downloadPath": os.path.abspath(download_dir)})
+
+
+def download_finished(download_dir):
+    """Check if the download directory holds a downloaded file and no downloads in progress."""
+    with os.scandir(download_dir) as entries:
+        file_names = [entry.name for entry in entries if entry.is_file()]
+    return bool(file_names) and not any(file_name.endswith(".crdownload") for file_name in file_names)
+
+
+def download_in_progress(download_dir):
+    """Check if the download directory holds a download that Chrome is still writing."""
+    with os.scandir(download_dir) as entries:
+        return any(entry.is_file() and entry.name.endswith(".crdownload") for entry in entries)
 
 
 def wait_for_download_completion(download_dir, timeout=60, retries=3):
-    """Wait for the download process to complete with retries."""
+    """Wait for the download process to complete with retries.
+    The directory is checked with a growing interval, so a fast download is picked up right away.
+    The wait is only repeated while a download is still in progress, not when no download has started."""
     for attempt in range(retries):
-        seconds = 0
-        while seconds < timeout:
-            time.sleep(1)
-            files = os.listdir(download_dir)
-            if any(file.endswith(".crdownload") for file in files):
-                seconds += 1
-            else:
+        deadline = time.monotonic() + timeout
+        for check in itertools.count():
+            if download_finished(download_dir):
                 return True
-        print(f"Retrying download check, attempt {attempt + 1}/{retries}")
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(DOWNLOAD_POLL_INTERVALS[min(check, len(DOWNLOAD_POLL_INTERVALS) - 1)])
+        if not download_in_progress(download_dir):
+            print(f"No download started in {download_dir} within {timeout} seconds")
+            return False
+        print(f"Download still in progress, retrying download check, attempt {attempt + 1}/{retries}")
     return False
 
 
@@ -103,20 +174,34 @@ def switch_to_new_tab(browser):
         browser.switch_to.window(browser.window_handles[1])
 
 
-def fetch_aftaler(connection_string, organisation):
-    """Fetch dataftaler from the database for error handling."""
-    with pyodbc.connect(connection_string) as connection:
+def fetch_aftaler(connection_string, organisations):
+    """Fetch dataftaler for the given organisations from the database for error handling.
+    All organisations are fetched in one query and split by organisation in a single pass."""
+    rows_by_organisation = {organisation: [] for organisation in organisations}
+    if not organisations:
+        return rows_by_organisation
+
+    # The database compares case-insensitively and ignores trailing spaces, so the rows are
+    # matched back to the requested names the same way
+    requested_names = {organisation.strip().casefold(): organisation for organisation in organisations}
+    placeholders = ", ".join("?" * len(organisations))
+    with closing(pyodbc.connect(connection_string)) as connection:
         cursor = connection.cursor()
 
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT [InstRegNr], [Organisation]
             FROM [RPA].[rpa].[MBU003Dataaftaler]
-            WHERE Organisation = ?
-        """, organisation)
+            WHERE Organisation IN ({placeholders})
+        """, *organisations)
 
-        rows = cursor.fetchall()
+        for row in cursor:
+            organisation = requested_names.get(str(row.Organisation).strip().casefold())
+            if organisation is None:
+                print(f"Skipping InstRegNr {row.InstRegNr} with unexpected organisation '{row.Organisation}'")
+                continue
+            rows_by_organisation[organisation].append(row)
 
-        return rows
+    return rows_by_organisation
 
 
 def add_columns_to_dataframe(file_path, instregnr, organisation):
@@ -150,11 +235,23 @@ def click_element_with_retries(browser, by, value, retries=4):
             return True
         except (TimeoutException, ElementClickInterceptedException, StaleElementReferenceException) as e:
             print(f"Attempt {attempt + 1} failed: {e}")
-            time.sleep(2)
+            if attempt < retries - 1:
+                time.sleep(CLICK_RETRY_INTERVALS[min(attempt, len(CLICK_RETRY_INTERVALS) - 1)])
     print(f"Failed to click element '{value}' after {retries} attempts")
     return False
 
 
+def click_located_element(browser, element, by, value):
+    """Click an element that has already been located, so the DOM isn't searched again.
+    Falls back to locating the element again if the click fails."""
+    try:
+        element.click()
+        return True
+    except (ElementClickInterceptedException, StaleElementReferenceException) as e:
+        print(f"Clicking located element '{value}' failed: {e}")
+        return click_element_with_retries(browser, by, value)
+
+
 def handle_notifications_popup(browser, notification_mail):
     """Handle the notification popups that may obstruct the automation process."""
     try:
@@ -191,7 +288,6 @@ def enter_organisation(browser, org, organisation_name, base_dir, error_log, not
         try:
             print(f"Processing organisation: {organisation_name}, InstRegNr: {org.InstRegNr}")
             browser.get('https://tilslutning.stil.dk/tilslutning?select-organisation=true')
-            browser.refresh()
 
             if organisation_name == "Dagtilbud":
                 print("Switching to Dagtilbud tab...")
@@ -204,7 +300,7 @@ def enter_organisation(browser, org, organisation_name, base_dir, error_log, not
                 EC.visibility_of_element_located((By.XPATH, f"//*[contains(text(), '{org.InstRegNr}')]"))
             )
             browser.execute_script("arguments[0].scrollIntoView(true);", row)
-            click_element_with_retries(browser, By.XPATH, f"//*[contains(text(), '{org.InstRegNr}')]")
+            click_located_element(browser, row, By.XPATH, f"//*[contains(text(), '{org.InstRegNr}')]")
             print(f"Clicked row for {org.InstRegNr}...")
 
             org_df = process_organisation(browser, org, organisation_name, base_dir, error_log, notification_mail, attempt)
@@ -252,27 +348,26 @@ def process_organisation(browser, org, organisation_name, base_dir, error_log, n
             WebDriverWait(browser, 5).until(
                 EC.presence_of_element_located((By.CSS_SELECTOR, "table"))
             )
-            table_text = browser.find_element(By.TAG_NAME, 'body').text
-            return "Endnu ingen forespørgsler på dataadgange." not in table_text
+            # Look up the empty-state message instead of reading the text of the whole page
+            empty_messages = browser.find_elements(By.XPATH, "//*[contains(text(), 'Endnu ingen forespørgsler på dataadgange.')]")
+            return not empty_messages
         except TimeoutException:
             return True  # Assume there are requests if timeout occurs
 
-    def handle_file_download_and_processing(org, organisation_name, base_dir, attempt):
+    def handle_file_download_and_processing(org, organisation_name, download_dir, attempt):
         """Handles file download and processing logic."""
-        download_dir = os.path.join(base_dir, "Exports")
-        processed_dir = os.path.join(download_dir, "processed")
-        os.makedirs(processed_dir, exist_ok=True)
+        processed_dir = os.path.join(base_dir, "Exports", "processed")
 
         if not wait_for_download_completion(download_dir):
             return log_error(f"ERROR: Download failed or timed out for {organisation_name}, InstRegNr: {org.InstRegNr} on attempt {attempt + 1}.")
 
-        files_in_dir = [os.path.join(download_dir, f) for f in os.listdir(download_dir)]
-        if not files_in_dir:
+        with os.scandir(download_dir) as entries:
+            downloaded_files = [entry for entry in entries if entry.is_file()]
+        if not downloaded_files:
             return log_error(f"No files found in {download_dir} for {organisation_name}, InstRegNr: {org.InstRegNr} on attempt {attempt + 1}.")
 
-        latest_file = max(files_in_dir, key=os.path.getctime)
-        if not os.path.isfile(latest_file):
-            return log_error(f"File {latest_file} not found after download on attempt {attempt + 1}. Download might have failed.")
+        # DirEntry caches the stat result, so each file is only stat'ed once
+        latest_file = max(downloaded_files, key=lambda entry: entry.stat().st_ctime).path
 
         org_df = add_columns_to_dataframe(latest_file, org.InstRegNr, organisation_name)
         if org_df is None or org_df.empty:
@@ -299,6 +394,11 @@ def process_organisation(browser, org, organisation_name, base_dir, error_log, n
             print(f"No data requests for {organisation_name}, InstRegNr: {org.InstRegNr}. Skipping processing.")
             return org_df
 
+        # Each call downloads into its own new folder, so the export can't be mixed up with another file,
+        # not even one left behind by an earlier attempt or by the retry of missing organisations
+        download_dir = os.path.join(base_dir, "Exports", f"{org.InstRegNr}_{attempt + 1}_{uuid.uuid4().hex}")
+        set_download_directory(browser, download_dir)
+
         for att in range(3):
             # Try to click the export button
             if not click_element_with_retries(browser, By.XPATH, "//button[text()='Eksport']"):
@@ -321,7 +421,7 @@ def process_organisation(browser, org, organisation_name, base_dir, error_log, n
             # If the loop completes without breaking, log the export failure
             return log_error(f"ERROR: Export failed for {organisation_name}, InstRegNr: {org.InstRegNr} after 3 download attempts. No file downloaded.")
 
-        return handle_file_download_and_processing(org, organisation_name, base_dir, attempt)
+        return handle_file_download_and_processing(org, organisation_name, download_dir, attempt)
 
     except (TimeoutException, NoSuchElementException) as e:
         return log_error(f"ERROR: Row not found or not clickable for {org.InstRegNr} on attempt {attempt + 1}, Exception: {str(e)}")
@@ -338,33 +438,46 @@ def save_overview(result_df, base_dir, error_log):
         result_df.sort_values(by='Instregnr', inplace=True)
         output_path = os.path.join(output_dir, output_filename)
 
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            result_df.to_excel(writer, index=False, sheet_name='Oversigt')
-            worksheet = writer.sheets['Oversigt']
-            worksheet.auto_filter.ref = worksheet.dimensions
-
-            for row in range(2, worksheet.max_row + 1):
-                status_cell = worksheet[f'R{row}']
-                statusændring_cell = worksheet[f'S{row}']  # 'statusændring' is in column S
-                if status_cell.value != "SLETTET":
-                    dv = DataValidation(type="list", formula1='"GODKEND, SLET, VENT"')
-                    dv.error_title = 'Invalid input'
-                    dv.error_message = 'Please select a value from the dropdown list'
-                    worksheet.add_data_validation(dv)
-                    dv.add(statusændring_cell)
-
-            # Adjust column widths but limit the max width
-            max_column_width = 30
-            for col in worksheet.columns:
-                max_length = 0
-                column = col[0].column_letter
-                for cell in col:
-                    try:
-                        max_length = max(max_length, len(str(cell.value)))
-                    except (TypeError, ValueError):
-                        pass
-                adjusted_width = min(max_length + 2, max_column_width)
-                worksheet.column_dimensions[column].width = adjusted_width
+        # Write the workbook in write-only mode, which streams the rows to the file
+        # instead of keeping a Cell object in memory for every value
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Oversigt')
+        worksheet.auto_filter.ref = f"A1:{get_column_letter(len(result_df.columns))}{len(result_df.index) + 1}"
+
+        # One data validation covers the 'statusændring' cells (column S) of all agreements
+        # whose status (column R) isn't SLETTET
+        dv = DataValidation(type="list", formula1='"GODKEND, SLET, VENT"')
+        dv.error_title = 'Invalid input'
+        dv.error_message = 'Please select a value from the dropdown list'
+        # Consecutive rows are added as one range, e.g. S2:S40, instead of cell by cell
+        rows = enumerate(result_df.iloc[:, 17] != "SLETTET", start=2)
+        for editable, group in itertools.groupby(rows, key=lambda row: row[1]):
+            if editable:
+                group_rows = [row for row, _ in group]
+                dv.add(f'S{group_rows[0]}:S{group_rows[-1]}')
+        if dv.sqref:
+            worksheet.data_validations.append(dv)
+
+        # Adjust column widths to the longest value in the DataFrame but limit the max width.
+        # In write-only mode the widths must be set before any rows are written.
+        max_column_width = 30
+        for column_index, column_name in enumerate(result_df.columns, start=1):
+            max_length = max(len(str(column_name)), result_df[column_name].astype(str).str.len().max())
+            adjusted_width = min(max_length + 2, max_column_width)
+            worksheet.column_dimensions[get_column_letter(column_index)].width = adjusted_width
+
+        header = []
+        for column_name in result_df.columns:
+            cell = WriteOnlyCell(worksheet, value=column_name)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        worksheet.append(header)
+
+        # Missing values are written as empty cells, like pandas does
+        values_df = result_df.astype(object).where(result_df.notna(), None)
+        for row in values_df.itertuples(index=False, name=None):
+            worksheet.append(row)
+        workbook.save(output_path)
 
     # Save Error Log
     if error_log:
@@ -377,15 +490,26 @@ def save_overview(result_df, base_dir, error_log):
         error_log_df.to_excel(error_log_path, index=False, sheet_name='Errors')
 
 
-def retry_missing_organisations(expected_instregnr, result_df, browser, base_dir, error_log, notification_mail, table_organisation, organisation_name):
+def processed_instregnr(frames):
+    """Get the InstRegNr of all organisations with rows in the collected frames."""
+    return set().union(*(frame['Instregnr'].unique() for frame in frames))
+
+
+def collect_organisation(frames, browser, org, organisation_name, base_dir, error_log, notification_mail):
+    """Process an organisation and add its rows to the collected frames."""
+    org_df = enter_organisation(browser, org, organisation_name, base_dir, error_log, notification_mail)
+    if not org_df.empty:
+        frames.append(org_df)
+
+
+def retry_missing_organisations(expected_instregnr, frames, browser, base_dir, error_log, notification_mail, table_organisation, organisation_name):
     """Retry processing missing organisations."""
-    unique_instregnr_in_results = set(result_df['Instregnr'].unique())
-    missing_instregnr = expected_instregnr - unique_instregnr_in_results
+    missing_instregnr = expected_instregnr - processed_instregnr(frames)
 
     print(f"Retrying to process failed {organisation_name}...")
     for org in table_organisation:
         if org.InstRegNr in missing_instregnr:
-            result_df = pd.concat([result_df, enter_organisation(browser, org, organisation_name, base_dir, error_log, notification_mail)])
+            collect_organisation(frames, browser, org, organisation_name, base_dir, error_log, notification_mail)
 
 
 def run_overview_creation(base_dir, connection_string, notification_mail, dagtilbud, institutioner):
@@ -393,14 +517,20 @@ def run_overview_creation(base_dir, connection_string, notification_mail, dagtil
     # Clear the base directory before processing
     clear_base_directory(base_dir)
 
-    # Create necessary directories again
-    os.makedirs(os.path.join(base_dir, "Exports"), exist_ok=True)
+    # Create necessary directories again, including the folder for processed exports
+    os.makedirs(os.path.join(base_dir, "Exports", "processed"), exist_ok=True)
     os.makedirs(os.path.join(base_dir, "Output"), exist_ok=True)
 
+    # Fetch the organisations up front in a single query
+    organisations = [organisation for organisation, include in (("Institutioner", institutioner), ("Dagtilbud", dagtilbud)) if include == "True"]
+    aftaler = fetch_aftaler(connection_string, organisations)
+
     browser = initialize_browser(base_dir)
 
-    result_df = pd.DataFrame()
+    # The rows of each organisation are collected and concatenated once at the end
+    frames = []
     error_log = []
+    expected_instregnr = set()
 
     try:
         open_stil_connection(browser)
@@ -410,27 +540,16 @@ def run_overview_creation(base_dir, connection_string, notification_mail, dagtil
             EC.element_to_be_clickable((By.ID, "organisation-search"))
         )
 
-        expected_instregnr = set()
-
-        if institutioner == "True":
-            table_institution = fetch_aftaler(connection_string, "Institutioner")
-            expected_instregnr.update(org.InstRegNr for org in table_institution)
-            print("Processing institutioner tab...")
-            for org in table_institution:
-                result_df = pd.concat([result_df, enter_organisation(browser, org, "Institutioner", base_dir, error_log, notification_mail)])
-
-            if result_df is not None and not result_df.empty:
-                retry_missing_organisations(expected_instregnr, result_df, browser, base_dir, error_log, notification_mail, table_institution, "Institutioner")
-
-        if dagtilbud == "True":
-            table_dagtilbud = fetch_aftaler(connection_string, "Dagtilbud")
-            expected_instregnr.update(org.InstRegNr for org in table_dagtilbud)
-            print("Processing dagtilbud tab...")
-            for org in table_dagtilbud:
-                result_df = pd.concat([result_df, enter_organisation(browser, org, "Dagtilbud", base_dir, error_log, notification_mail)])
+        # Process each requested tab, Institutioner before Dagtilbud
+        for organisation_name in organisations:
+            table_organisation = aftaler.get(organisation_name, [])
+            expected_instregnr.update(org.InstRegNr for org in table_organisation)
+            print(f"Processing {organisation_name.lower()} tab...")
+            for org in table_organisation:
+                collect_organisation(frames, browser, org, organisation_name, base_dir, error_log, notification_mail)
 
-            if result_df is not None and not result_df.empty:
-                retry_missing_organisations(expected_instregnr, result_df, browser, base_dir, error_log, notification_mail, table_dagtilbud, "Dagtilbud")
+            if frames:
+                retry_missing_organisations(expected_instregnr, frames, browser, base_dir, error_log, notification_mail, table_organisation, organisation_name)
 
     except TimeoutException as e:
         error_message = f"Timeout error occurred: {str(e)}"
@@ -443,11 +562,12 @@ def run_overview_creation(base_dir, connection_string, notification_mail, dagtil
 
     finally:
 
-        if result_df is not None and not result_df.empty:
-            unique_instregnr_in_results = set(result_df['Instregnr'].unique())
-            missing_instregnr = expected_instregnr - unique_instregnr_in_results
+        if frames:
+            result_df = pd.concat(frames, ignore_index=True)
+            missing_instregnr = expected_instregnr - processed_instregnr(frames)
         else:
-            print("ERROR: result_df is None or empty. Cannot verify processed InstRegNr.")
+            print("ERROR: result_df is empty. Cannot verify processed InstRegNr.")
+            result_df = pd.DataFrame()
             missing_instregnr = expected_instregnr
 
         if missing_instregnr:
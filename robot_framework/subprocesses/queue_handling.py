@@ -12,6 +12,15 @@ from .overview_creation import open_stil_connection
 MAX_RETRIES = 3
 RETRY_DELAY = 5
 DEFAULT_WAIT_TIME = 30
+# Seconds to wait for the agreement table to re-render after changing its filters
+TABLE_RERENDER_WAIT_TIME = 5
+
+# The status changes made with the status button, keyed by the action prefix of the queue element reference:
+# (required current status, new status, button text, description of the new status)
+STATUS_CHANGES = {
+    'Godkend': ('VENTER', 'GODKENDT', 'Godkend', 'approved'),
+    'Vent': ('GODKENDT', 'VENTER', 'Til Venter', 'awaiting'),
+}
 
 
 def process_queue_elements(queue_elements, orchestrator_connection):
@@ -47,12 +56,13 @@ def click_element_with_retries(browser, by, value, max_retries=MAX_RETRIES):
 
 
 def group_elements_by_instregnr(queue_elements):
-    """Organize queue elements into groups based on their institution registration number ('instregnr')."""
+    """Organize queue elements into groups based on their institution registration number ('instregnr').
+    Each element is paired with its parsed data, so the data is only parsed once."""
     grouped_elements = {}
     for element in queue_elements:
         element_data = json.loads(element.data)
         instregnr = element_data['Instregnr']
-        grouped_elements.setdefault(instregnr, []).append(element)
+        grouped_elements.setdefault(instregnr, []).append((element, element_data))
 
     # Print the total amount of element
     print(f"Total amount of elements: {len(queue_elements)}")
@@ -60,9 +70,8 @@ def group_elements_by_instregnr(queue_elements):
 
 
 def handle_elements_for_instregnr(browser, instregnr, elements, orchestrator_connection):
-    """Process all queue elements for a specific institution registration number."""
-    element_data = json.loads(elements[0].data)  # Assume all elements have the same organization
-    org = element_data['Organisation']
+    """Process all queue elements, paired with their parsed data, for a specific institution registration number."""
+    org = elements[0][1]['Organisation']  # Assume all elements have the same organization
 
     orchestrator_connection.log_trace(f"Processing {len(elements)} queue elements for {instregnr} ({org})")
 
@@ -76,19 +85,18 @@ def handle_elements_for_instregnr(browser, instregnr, elements, orchestrator_con
             time.sleep(RETRY_DELAY)
     else:
         # Mark elements as failed after max retries
-        for element in elements:
+        for element, _ in elements:
             orchestrator_connection.set_queue_element_status(element.id, QueueStatus.FAILED, "Failed entering Data Access Administration")
         orchestrator_connection.log_error(f"Failed after {MAX_RETRIES} retries: Error navigating to data access administration. All elements with Instregnr: {instregnr} set to failed.")
         return
 
     # Process each individual element for the institution
-    for element in elements:
-        process_element(browser, element, orchestrator_connection)
+    for element, element_data in elements:
+        process_element(browser, element, element_data, orchestrator_connection)
 
 
-def process_element(browser, queue_element, orchestrator_connection):
+def process_element(browser, queue_element, element_data, orchestrator_connection):
     """Handle an individual queue element with retry logic."""
-    element_data = json.loads(queue_element.data)
     ref = queue_element.reference
 
     orchestrator_connection.log_trace(f"Processing element {queue_element.id} with reference '{ref}'")
@@ -106,7 +114,7 @@ def process_element(browser, queue_element, orchestrator_connection):
             orchestrator_connection.set_queue_element_status(queue_element.id, QueueStatus.FAILED, message)
             orchestrator_connection.log_error(f"Failed to process element {queue_element.id}: {message}. Retrying...")
 
-        except (TimeoutException, NoSuchElementException) as e:
+        except (TimeoutException, NoSuchElementException, StaleElementReferenceException) as e:
             orchestrator_connection.log_error(f"Error processing element {queue_element.id}: {e}. Retrying...")
             print(f"Error processing element {queue_element.id}: {e}. Retrying...")
             time.sleep(RETRY_DELAY)
@@ -116,7 +124,7 @@ def process_element(browser, queue_element, orchestrator_connection):
 
 
 def click_checkbox_if_not_checked(browser, checkbox_id):
-    """Click a checkbox if it is not already checked."""
+    """Click a checkbox if it is not already checked. Returns True if the checkbox was clicked."""
     # Wait until the checkbox is present in the DOM
     checkbox = WebDriverWait(browser, 10).until(
         EC.presence_of_element_located((By.ID, checkbox_id))
@@ -125,6 +133,8 @@ def click_checkbox_if_not_checked(browser, checkbox_id):
     # Check if the checkbox is already checked
     if not checkbox.is_selected():
         checkbox.click()  # Click the checkbox to check it
+        return True
+    return False
 
 
 def perform_data_access(browser, element_data, ref, queue_element):  # pylint: disable=too-many-return-statements
@@ -132,10 +142,21 @@ def perform_data_access(browser, element_data, ref, queue_element):  # pylint: d
     system_name = element_data['systemNavn']
     service_name = element_data['serviceNavn']
     status = element_data['status']
-    time.sleep(2)  # Add sleep to account for possible delays
+    stripped_system_name = system_name.strip()
+    stripped_service_name = service_name.strip()
+    action = ref.partition('_')[0]
 
-    click_checkbox_if_not_checked(browser, 'visSlettede')
-    click_checkbox_if_not_checked(browser, 'visPassive')
+    old_table = WebDriverWait(browser, DEFAULT_WAIT_TIME).until(
+        EC.presence_of_element_located((By.XPATH, "//table[@class='stil-tabel']"))
+    )
+    toggled_slettede = click_checkbox_if_not_checked(browser, 'visSlettede')
+    toggled_passive = click_checkbox_if_not_checked(browser, 'visPassive')
+    if toggled_slettede or toggled_passive:
+        # Wait for the table to re-render with the new filters, so the old rows aren't read
+        try:
+            WebDriverWait(browser, TABLE_RERENDER_WAIT_TIME).until(EC.staleness_of(old_table))
+        except TimeoutException:
+            print("Table wasn't replaced after changing the filters. Continuing with the current table.")
 
     # Wait until the table container is fully loaded
     table = WebDriverWait(browser, DEFAULT_WAIT_TIME).until(
@@ -165,41 +186,24 @@ def perform_data_access(browser, element_data, ref, queue_element):  # pylint: d
         print(f"Checking row: {row_texts}")
 
         # Check if both system_name and service_name are present in row_texts
-        if (system_name.strip() in [text.strip() for text in row_texts] and service_name.strip() in [text.strip() for text in row_texts]):
+        row_text_set = set(row_texts)  # The texts are already stripped
+        if stripped_system_name in row_text_set and stripped_service_name in row_text_set:
 
             browser.execute_script("arguments[0].scrollIntoView(true);", row)
             print(f"Found agreement for {system_name} - {service_name}")
             browser.execute_script("arguments[0].style.backgroundColor = 'yellow'", row)  # Highlight the row for visibility
 
             # Additional status checks and actions
-            if ref.startswith('Godkend') and status == 'VENTER':
-                print(f"Element expected pre-status: {status}. Getting ready to change status to 'GODKENDT'...")
-                pre_status = check_status_change(system_name, service_name, 'GODKENDT', browser, row_texts)
-                if pre_status:
-                    print("Agreement already approved")
-                    return True, "Agreement already approved"
-                print("Proceeding to change agreement status to 'GODKENDT'...")
-                change_status(browser, queue_element, row)
-                time.sleep(2)  # Add sleep to account for possible delays
-                browser.switch_to.default_content()
-                browser.execute_script("window.scrollTo(0, 0)")
-                browser.switch_to.default_content()
-                confirmation = WebDriverWait(browser, 10).until(
-                    EC.presence_of_element_located((By.XPATH, "//*[contains(text(), 'Status for dataadgang er opdateret.')]"))
-                )
-                if confirmation:
-                    print("Agreement succesfully changed to 'GODKENDT'")
-                    return True, "Agreement status changed to 'GODKENDT'"
-
-            if ref.startswith('Vent') and status == 'GODKENDT':
-                print(f"Element expected pre-status: {status}. Getting ready to change status to 'VENTER'...")
-                pre_status = check_status_change(system_name, service_name, 'VENTER', browser, row_texts)
+            if action in STATUS_CHANGES and status == STATUS_CHANGES[action][0]:
+                _, new_status, _, description = STATUS_CHANGES[action]
+                print(f"Element expected pre-status: {status}. Getting ready to change status to '{new_status}'...")
+                pre_status = check_status_change(system_name, service_name, new_status, browser, row_texts)
                 if pre_status:
-                    print("Agreement already awaiting")
-                    return True, "Agreement already awaiting"
-                print("Proceeding to change agreement status to 'VENTER'...")
-                change_status(browser, queue_element, row)
-                time.sleep(2)  # Add sleep to account for possible delays
+                    print(f"Agreement already {description}")
+                    return True, f"Agreement already {description}"
+                print(f"Proceeding to change agreement status to '{new_status}'...")
+                if not change_status(browser, action, row):
+                    return False, f"Failed to change agreement status to '{new_status}'"
                 browser.switch_to.default_content()
                 browser.execute_script("window.scrollTo(0, 0)")
                 browser.switch_to.default_content()
@@ -207,10 +211,10 @@ def perform_data_access(browser, element_data, ref, queue_element):  # pylint: d
                     EC.presence_of_element_located((By.XPATH, "//*[contains(text(), 'Status for dataadgang er opdateret.')]"))
                 )
                 if confirmation:
-                    print("Agreement succesfully changed to 'VENTER'")
-                    return True, "Agreement status changed to 'VENTER'"
+                    print(f"Agreement succesfully changed to '{new_status}'")
+                    return True, f"Agreement status changed to '{new_status}'"
 
-            if ref.startswith('Slet') and status != 'SLETTET':
+            if action == 'Slet' and status != 'SLETTET':
                 print(f"Element expected pre-status: {status}. Getting ready to delete agreement...")
                 pre_status = check_status_change(system_name, service_name, 'SLETTET', browser, row_texts)
                 if pre_status:
@@ -240,9 +244,8 @@ def check_status_change(system_name, service_name, expected_status, browser, col
             WebDriverWait(browser, 10).until(
                 EC.presence_of_element_located((By.CSS_SELECTOR, 'table.stil-tabel'))
             )
-            if (system_name.strip() in [text.strip() for text in column_texts] and service_name.strip() in [text.strip() for text in column_texts] and expected_status in [text.strip() for text in column_texts]):
-                return True
-            return False
+            column_text_set = {text.strip() for text in column_texts}
+            return system_name.strip() in column_text_set and service_name.strip() in column_text_set and expected_status in column_text_set
         except StaleElementReferenceException as e:
             print(f"Encountered a stale element exception: {e}. Retrying...")
             retry_count += 1
@@ -253,8 +256,9 @@ def check_status_change(system_name, service_name, expected_status, browser, col
     return False
 
 
-def change_status(browser, queue_element, row):
-    """Click the status change button and change status based on the queue element's reference."""
+def change_status(browser, action, row):
+    """Click the status change button and change status based on the action of the queue element's reference.
+    Returns True once the status change has been confirmed and the row has been re-rendered."""
     status_button = WebDriverWait(row, 10).until(
             EC.presence_of_element_located((By.XPATH, ".//img[@class='hand dataadgang-status-knap' and @title='Skift status']"))
         )
@@ -263,24 +267,22 @@ def change_status(browser, queue_element, row):
 
     status_button.click()
 
-    if queue_element.reference.startswith('Vent'):
-        print("Clicking Venter button")
-        time.sleep(1)  # Add sleep to account for possible delays
-        click_element_with_retries(browser, By.XPATH, '//button[text()="Til Venter"]')
+    if action in STATUS_CHANGES:
+        _, new_status, button_text, _ = STATUS_CHANGES[action]
+        print(f"Clicking {button_text} button")
+        if not click_element_with_retries(browser, By.XPATH, f'//button[text()="{button_text}"]'):
+            return False
         WebDriverWait(browser, 20).until(
-            EC.visibility_of_element_located((By.XPATH, "//*[contains(text(), 'Er du sikker på, at adgangens status skal ændres til VENTER')]"))
+            EC.visibility_of_element_located((By.XPATH, f"//*[contains(text(), 'Er du sikker på, at adgangens status skal ændres til {new_status}')]"))
         )
 
-    elif queue_element.reference.startswith('Godkend'):
-        print("Clicking Godkendt button")
-        time.sleep(1)
-        click_element_with_retries(browser, By.XPATH, '//button[text()="Godkend"]')
-        WebDriverWait(browser, 20).until(
-            EC.visibility_of_element_located((By.XPATH, "//*[contains(text(), 'Er du sikker på, at adgangens status skal ændres til GODKENDT')]"))
-        )
+    if not click_element_with_retries(browser, By.XPATH, '/html/body/div[4]/div/div/div/button[2]'):
+        return False
 
-    click_element_with_retries(browser, By.XPATH, '/html/body/div[4]/div/div/div/button[2]')
-    time.sleep(2)
+    # Wait for the row to be re-rendered, so a message left on the page by an earlier element
+    # isn't taken as the confirmation of this one
+    WebDriverWait(browser, 10).until(EC.staleness_of(row))
+    return True
 
 
 def delete_agreement(browser, queue_element, row):
@@ -290,10 +292,14 @@ def delete_agreement(browser, queue_element, row):
         browser.execute_script("arguments[0].style.backgroundColor = 'red'", delete_button)  # Highlight the button for visibility
 
         delete_button.click()
-        time.sleep(2)  # Add sleep to account for possible delays
         print("Clicking Slet button")
-        click_element_with_retries(browser, By.XPATH, '//button[text()="Slet"]')
-        time.sleep(2)
+        if not click_element_with_retries(browser, By.XPATH, '//button[text()="Slet"]'):
+            print(f"Failed to confirm deletion for queue element {queue_element.id}")
+            return False, "Failed to delete agreement"
+
+        # Wait for the row to be removed or re-rendered, so a message left on the page by an earlier
+        # element isn't taken as the confirmation of this one
+        WebDriverWait(browser, 10).until(EC.staleness_of(row))
         browser.switch_to.default_content()
         browser.execute_script("window.scrollTo(0, 0)")
         browser.switch_to.default_content()
@@ -66,13 +66,14 @@ def generate_short_hash(data, length=8):
 
 def upload_to_queue(approve_data, delete_data, wait_data, orchestrator_connection):
     """Uploads the given data to the Databehandlingsaftale_Status_Queue in Orchestrator."""
-    approve_data_json = [json.dumps(data) for data in approve_data]
-    delete_data_json = [json.dumps(data) for data in delete_data]
-    wait_data_json = [json.dumps(data) for data in wait_data]
-
-    approve_references = [f"Godkend_{generate_short_hash(data)}" for data in approve_data]
-    delete_references = [f"Slet_{generate_short_hash(data)}" for data in delete_data]
-    wait_references = [f"Vent_{generate_short_hash(data)}" for data in wait_data]
+    # Serialize each element once with sorted keys, so the same string is both uploaded and hashed
+    approve_data_json = [json.dumps(data, sort_keys=True) for data in approve_data]
+    delete_data_json = [json.dumps(data, sort_keys=True) for data in delete_data]
+    wait_data_json = [json.dumps(data, sort_keys=True) for data in wait_data]
+
+    approve_references = [f"Godkend_{generate_short_hash(data)}" for data in approve_data_json]
+    delete_references = [f"Slet_{generate_short_hash(data)}" for data in delete_data_json]
+    wait_references = [f"Vent_{generate_short_hash(data)}" for data in wait_data_json]
 
     # Check for duplicated references and change them if necessary
     all_references = approve_references + delete_references + wait_references